@@ -1,6 +1,7 @@
 """A Google Cloud Python Pulumi program"""
 
 import base64
+import hashlib
 import pulumi
 import utils
 from typing import List, NamedTuple
@@ -42,6 +43,16 @@ LOCATION_TO_INDEX = {
     "jp": 4,
 }
 SETUP_SCRIPT_PATH = "/usr/local/bin/setup_epaxos.sh"
+SSH_OPTS = (
+    "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null "
+    "-o ConnectTimeout=5 -o BatchMode=yes"
+)
+# Retry budgets for the readiness-gated deploy. With a 2s initial delay doubling
+# up to 30s, 20 attempts give a VM roughly 8 minutes to accept SSH and 40
+# attempts give the startup script roughly 18 minutes to finish installing.
+SSH_RETRY_ATTEMPTS = 20
+SETUP_RETRY_ATTEMPTS = 40
+DEPLOY_STAGES = ["instance", "ssh", "rsync", "install"]
 VM_IMAGE_URL = "https://www.googleapis.com/compute/beta/projects/ubuntu-os-pro-cloud/global/images/ubuntu-pro-1804-bionic-v20240516"
 
 
@@ -49,6 +60,22 @@ if pulumi.get_stack() != "dev":
     dev = StackReference(DEV_STACK)
 
 
+def retry_with_backoff(command, attempts, delay=2, max_delay=30):
+    """
+    Wraps 'command' in a bash loop that reruns it until it succeeds, sleeping
+    with exponential backoff between attempts. Gives up with a non-zero exit
+    code after 'attempts' tries.
+    """
+    return (
+        f"(attempt=1; delay={delay}; "
+        f"until {command}; do "
+        f"if [ $attempt -ge {attempts} ]; then exit 1; fi; "
+        "sleep $delay; attempt=$((attempt + 1)); "
+        f"delay=$((delay * 2 > {max_delay} ? {max_delay} : delay * 2)); "
+        "done)"
+    )
+
+
 class GCloudInstance:
     def id(self):
         raise NotImplementedError()
@@ -96,10 +123,12 @@ class GCloudInstance:
         self.setup_script = self.create_setup_script()
 
         self.instance_resource = None
+        self.ssh_resource = None
         self.rsync_resource = None
         self.install_resource = None
         self.run_resource = None
         self.metrics_resource = None
+        self.stage_times = {}
 
     def create_setup_script(self):
         epaxos_folder_name = (
@@ -142,8 +171,7 @@ sudo chown $(whoami):$(whoami) {SETUP_SCRIPT_PATH}
         command,
         host_str,
         delete_command=None,
-        this_resource=None,
-        extra_depends_on=[],
+        depends_on=[],
         parent_resource=None,
     ):
         return remote.Command(
@@ -152,38 +180,65 @@ sudo chown $(whoami):$(whoami) {SETUP_SCRIPT_PATH}
                 host=host_str,
                 user=self.unix_username,
                 private_key=base64.b64decode(self.private_key_b64).decode("utf-8"),
+                dial_error_limit=SSH_RETRY_ATTEMPTS,
             ),
             create=command,
             delete=delete_command,
             opts=ResourceOptions(
-                depends_on=[
-                    r
-                    for r in [
-                        self.install_resource,
-                        self.rsync_resource,
-                        self.instance_resource,
-                    ]
-                    + extra_depends_on
-                    if r is not None and r != this_resource
-                ],
+                depends_on=[r for r in depends_on if r is not None],
                 parent=parent_resource,
             ),
         )
 
+    def mark_stage(self, stage, resource):
+        """
+        Records the time at which 'resource' finished being created, so that
+        deploy timings can be reported per stage. The marker is keyed on the
+        resource's id, so it is re-created whenever the resource is replaced.
+        """
+        marker = time.Static(
+            f"time_{stage}-{self.id()}",
+            triggers={"id": Output.from_input(resource).apply(lambda r: r.id)},
+            opts=ResourceOptions(depends_on=[resource]),
+        )
+        self.stage_times[stage] = marker.unix
+
+    def wait_for_ssh(self):
+        # Probe with the same user and key that run_remote_command uses, so the
+        # gate only opens once the install step can actually log in. The key
+        # is passed through the environment and only written to a temp file
+        # for the duration of the probe.
+        ssh_command = (
+            'keyfile=$(mktemp) && echo "$SSH_KEY_B64" | base64 -d > "$keyfile" '
+            '&& chmod 600 "$keyfile" && '
+            + retry_with_backoff(
+                'ssh -i "$keyfile" -l {user} {sshopts} {remote} true',
+                SSH_RETRY_ATTEMPTS,
+            )
+            + '; status=$?; rm -f "$keyfile"; exit $status'
+        )
+        self.ssh_resource = self.ip().apply(
+            lambda host_str: local.Command(
+                f"command_wait_ssh-{self.id()}",
+                create=ssh_command.format(
+                    user=self.unix_username, sshopts=SSH_OPTS, remote=host_str
+                ),
+                environment={"SSH_KEY_B64": Output.secret(self.private_key_b64)},
+                opts=ResourceOptions(depends_on=[self.instance_resource]),
+            )
+        )
+        self.mark_stage("ssh", self.ssh_resource)
+
     def run_go_installs(self):
         if self.go_path is None:
             raise ValueError("go_path is not set")
         if self.private_key_b64 is None:
             raise ValueError("private_key_b64 needs to be set in pulumi config")
 
-        run_setup_script = f"""\
-until {SETUP_SCRIPT_PATH}
-do
-    sleep 2
-done
-"""
+        # The setup script only exists once the startup script has finished
+        # installing go, so keep retrying it until then.
         install_command = (
-            f"$({run_setup_script}) && "
+            f"{retry_with_backoff(SETUP_SCRIPT_PATH, SETUP_RETRY_ATTEMPTS)} && "
             "export PATH=$PATH:/usr/local/go/bin && "
             f"export GOPATH={self.go_path} && "
             "go clean && "
@@ -196,29 +251,29 @@ done
                 "command_install",
                 install_command,
                 host_str,
-                this_resource=self.install_resource,
+                depends_on=[self.rsync_resource],
             )
         )
+        self.mark_stage("install", self.install_resource)
 
     def run_rsync(self):
-        sshopts = "ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
-        rsync_command = (
+        rsync_command = retry_with_backoff(
             'rsync --delete --exclude-from "{f}/.gitignore" '
-            '-re "{sshopts}" {f} {remote}:~'
+            '-re "ssh {sshopts}" {f} {remote}:~',
+            SSH_RETRY_ATTEMPTS,
         )
         self.rsync_resource = self.ip().apply(
             lambda str: local.Command(
                 f"command_rsync-{self.id()}",
                 create=rsync_command.format(
-                    sshopts=sshopts,
+                    sshopts=SSH_OPTS,
                     f=self.epaxos_dir,
                     remote=str,
                 ),
-                opts=ResourceOptions(
-                    depends_on=[r for r in [self.instance_resource] if r is not None]
-                ),
+                opts=ResourceOptions(depends_on=[self.ssh_resource]),
             )
         )
+        self.mark_stage("rsync", self.rsync_resource)
 
     def create_instance(self):
         name = self.id()
@@ -234,6 +289,20 @@ done
                 network="default",
             )
         ]
+        # Marks the start of this host's deploy. It is keyed on everything that
+        # replaces the instance, so a re-provisioned host gets a fresh start.
+        start_marker = time.Static(
+            f"time_start-{name}",
+            triggers={
+                "machine_type": self.machine_type,
+                "zone": self.zone(),
+                "image": VM_IMAGE_URL,
+                "setup_script": hashlib.sha256(
+                    self.setup_script.encode("utf-8")
+                ).hexdigest(),
+            },
+        )
+        self.stage_times["start"] = start_marker.unix
         self.instance_resource = Instance(
             f"instance_{name}",
             network_interfaces=network_interfaces,
@@ -242,7 +311,9 @@ done
             zone=self.zone(),
             boot_disk=boot_disk,
             metadata_startup_script=self.setup_script,
+            opts=ResourceOptions(depends_on=[start_marker]),
         )
+        self.mark_stage("instance", self.instance_resource)
         pulumi.export(
             f"public_ip-{name}",
             self.ip(),
@@ -271,7 +342,7 @@ class GCloudServer(GCloudInstance):
             port = 7070 + LOCATION_TO_INDEX[self.loc]
             # flags = f" -port {port} -maddr {master_ip} -addr {internal_ip} -e " # -e for epaxos
             flags = f" -port {port} -maddr {master_ip} -addr {internal_ip} "
-            server_command = "nohup epaxos/bin/server {} > output.txt 2>&1 &".format(
+            server_command = "nohup epaxos/bin/server {} >> output.txt 2>&1 &".format(
                 flags
             )
             delete_command = "kill $(pidof epaxos/bin/server)"
@@ -280,7 +351,7 @@ class GCloudServer(GCloudInstance):
                 server_command,
                 external_ip,
                 delete_command=delete_command,
-                extra_depends_on=[master_run_resource],
+                depends_on=[master_run_resource],
             )
 
         self.run_resource = Output.all(
@@ -353,7 +424,7 @@ class GCloudClient(GCloudInstance):
                 client_command,
                 external_ip,
                 delete_command=delete_command,
-                # extra_depends_on=dependencies,
+                # depends_on=dependencies,
                 parent_resource=parent,
             )
 
@@ -368,7 +439,7 @@ class GCloudClient(GCloudInstance):
                 f"command_metrics_{workload.id()}",
                 metrics_command,
                 ip,
-                extra_depends_on=[self.run_resource],
+                depends_on=[self.run_resource],
                 parent_resource=parent,
             )
         )
@@ -390,7 +461,7 @@ class GCloudMaster(GCloudInstance):
 
     def run_master(self, server_instances: List[GCloudServer]):
         master_command = (
-            "nohup epaxos/bin/master -N {len_ips} -ips {ips} > moutput.txt 2>&1 &"
+            "nohup epaxos/bin/master -N {len_ips} -ips {ips} >> moutput.txt 2>&1 &"
         )
 
         self.run_resource = Output.all(
@@ -414,16 +485,54 @@ class EPaxosDeployment:
         self.clients = {loc: GCloudClient(config, loc) for loc in self.locs}
         self.master = GCloudMaster(config, self.locs[0])
 
+    def instances(self) -> List[GCloudInstance]:
+        return (
+            [self.master]
+            + list(self.servers.values())
+            + list(self.clients.values())
+        )
+
     def deploy(self):
-        def deploy_instance(instance):
+        # Every host runs its own instance -> ssh -> rsync -> install chain, and
+        # no chain depends on another, so the engine provisions all zones in
+        # parallel and the deploy takes about as long as the slowest VM.
+        for instance in self.instances():
             instance.create_instance()
+        for instance in self.instances():
+            instance.wait_for_ssh()
             instance.run_rsync()
             instance.run_go_installs()
+        self.report_timings()
+
+    def report_timings(self):
+        """
+        Exports, per host, the number of seconds from the start of that host's
+        deploy until each stage finished, plus the slowest host's total. Hosts
+        left untouched by a later `pulumi up` keep their original timings.
+        """
+
+        def stage_offsets(instance_id, times):
+            offsets = {
+                stage: t - times[0] for stage, t in zip(DEPLOY_STAGES, times[1:])
+            }
+            pulumi.info(f"{instance_id} deploy timings (s): {offsets}")
+            return offsets
+
+        all_timings = []
+        for instance in self.instances():
+            timings = Output.all(
+                instance.stage_times["start"],
+                *[instance.stage_times[stage] for stage in DEPLOY_STAGES],
+            ).apply(lambda times, id=instance.id(): stage_offsets(id, times))
+            pulumi.export(f"deploy_timing-{instance.id()}", timings)
+            all_timings.append(timings)
 
-        deploy_instance(self.master)
-        for loc in self.locs:
-            deploy_instance(self.servers[loc])
-            deploy_instance(self.clients[loc])
+        pulumi.export(
+            "deploy_seconds",
+            Output.all(*all_timings).apply(
+                lambda timings: max(t[DEPLOY_STAGES[-1]] for t in timings)
+            ),
+        )
 
     def run_and_get_metrics(self):
         pulumi.info("Running master...")
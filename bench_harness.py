@@ -0,0 +1,219 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import typer
+
+from log_archive import LogArchive
+from workloads import GCloudClient, run_sweep, sweep_workloads
+
+CANNED_METRICS = {
+    "mean_lat_commit": 120.5,
+    "p50_lat_commit": 110.0,
+    "p90_lat_commit": 180.0,
+    "p95_lat_commit": 210.0,
+    "p99_lat_commit": 300.0,
+    "mean_lat_exec": 130.5,
+    "p50_lat_exec": 120.0,
+    "p90_lat_exec": 190.0,
+    "p95_lat_exec": 220.0,
+    "p99_lat_exec": 320.0,
+    "avg_tput": 850.0,
+    "total_ops": 8500,
+}
+
+# Stands in for the client binary: writes latency files of the configured
+# size and echoes its flags as its output.
+FAKE_CLIENT_SCRIPT = """#!/bin/bash
+head -c {log_bytes} /dev/urandom | base64 > latency.txt
+cp latency.txt lattput.txt
+echo "fake client $@"
+"""
+
+
+class FakeGCloudClient(GCloudClient):
+    """
+    A GCloudClient whose 'gcloud compute ssh' commands run locally in a
+    per-node directory instead of on a VM. Every real client method is used
+    unchanged; only the launch, kill and metrics commands are rewritten so they
+    are synchronous and return canned data. 'latency' seconds are slept before
+    each command to stand in for the SSH round trip.
+    """
+
+    REWRITES = {
+        "nohup bin/client": "bin/client",
+        "2>&1 &": "2>&1",
+        "kill $(pidof bin/client)": "true",
+        "python3 epaxos/scripts/client_metrics.py": "cat epaxos/metrics.json",
+    }
+
+    def __init__(self, loc, index, root, latency, log_bytes):
+        super().__init__((f"198.51.100.{index}", f"10.0.0.{index}"), loc)
+        self.index = index
+        self.latency = latency
+        self.calls = 0
+        self.node_dir = os.path.join(root, self.id())
+
+        epaxos_dir = os.path.join(self.node_dir, "epaxos")
+        os.makedirs(os.path.join(epaxos_dir, "bin"))
+        client_path = os.path.join(epaxos_dir, "bin", "client")
+        with open(client_path, "w") as file:
+            file.write(FAKE_CLIENT_SCRIPT.format(log_bytes=log_bytes * 3 // 4))
+        os.chmod(client_path, 0o755)
+        with open(os.path.join(epaxos_dir, "metrics.json"), "w") as file:
+            json.dump(CANNED_METRICS, file)
+
+    def flags(self, master_ip, workload):
+        # Fake locations are not in LOCATION_TO_INDEX, so use our own index.
+        flags = super().flags(master_ip, workload._replace(is_epaxos=False))
+        if workload.is_epaxos:
+            flags += f" -l {self.index}"
+        return flags
+
+    def _gssh_cmd(self, cmd):
+        if isinstance(cmd, list):
+            cmd = "; ".join(cmd)
+        for old, new in self.REWRITES.items():
+            cmd = cmd.replace(old, new)
+
+        self.calls += 1
+        sleep = f"sleep {self.latency} && " if self.latency > 0 else ""
+        return f"cd {self.node_dir} && {sleep}{cmd}"
+
+
+def run_bench(num_nodes, num_workloads, latency, log_bytes):
+    """
+    Runs a sweep of 'num_workloads' workloads against 'num_nodes' fake clients
+    and returns the harness overhead of each workload in seconds, i.e. its wall
+    time minus the simulated SSH latency. Also returns the peak RSS of this
+    process in bytes. Run it in a fresh process so the peak only covers this
+    sweep.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        clients = {
+            f"r{i:02d}": FakeGCloudClient(f"r{i:02d}", i, root, latency, log_bytes)
+            for i in range(num_nodes)
+        }
+        archive = LogArchive(os.path.join(root, "archive"))
+        workloads = [w for row in sweep_workloads(True) for w in row]
+        rows = [workloads[:num_workloads]]
+
+        overheads = []
+        last = {"time": time.perf_counter(), "calls": 0}
+
+        def on_workload(_):
+            now = time.perf_counter()
+            calls = sum(client.calls for client in clients.values())
+            simulated = (calls - last["calls"]) * latency
+            overheads.append(now - last["time"] - simulated)
+            last["time"] = now
+            last["calls"] = calls
+
+        errors = io.StringIO()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+            devnull
+        ), contextlib.redirect_stderr(errors):
+            metrics = run_sweep(
+                "10.0.0.254",
+                clients,
+                rows,
+                archive,
+                os.path.join(root, "metrics.json"),
+                stabilize_secs=0,
+                on_workload=on_workload,
+            )
+
+        failures = [
+            line
+            for line in errors.getvalue().splitlines()
+            if line.startswith(("ERROR", "Failed"))
+        ]
+        if failures:
+            raise RuntimeError("\n".join(failures))
+        for workload_metrics in metrics.workloads.values():
+            if len(workload_metrics.clients) != num_nodes:
+                raise RuntimeError("Fake sweep is missing client metrics")
+
+        # ru_maxrss is in kilobytes on Linux.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return overheads, peak_rss
+
+
+def main(
+    node_counts: str = "1,3,10,30",
+    workloads: int = 99,
+    latency_ms: float = 0,
+    log_kb: int = 64,
+    budget_ms: float = 250,
+    output: str = "",
+):
+    """
+    Measures the workload runner's own overhead by running sweeps against a
+    fake cluster of each size in 'node_counts'. Exits with a non-zero code if
+    the mean overhead per client per workload exceeds 'budget_ms'.
+    """
+    results = []
+    print(
+        f"{'nodes':>6} {'mean ms':>9} {'p50 ms':>9} {'max ms':>9} "
+        f"{'ms/client':>10} {'peak MB':>8}"
+    )
+    # Each node count runs in its own interpreter, so peak RSS is not carried
+    # over from earlier sizes.
+    context = multiprocessing.get_context("spawn")
+    for num_nodes in (int(n) for n in node_counts.split(",")):
+        pool = context.Pool(1)
+        try:
+            overheads, peak_rss = pool.apply(
+                run_bench, (num_nodes, workloads, latency_ms / 1000, log_kb * 1024)
+            )
+        finally:
+            pool.close()
+            pool.join()
+        overheads_ms = [o * 1000 for o in overheads]
+        result = {
+            "nodes": num_nodes,
+            "workloads": len(overheads_ms),
+            "mean_ms": statistics.mean(overheads_ms),
+            "p50_ms": statistics.median(overheads_ms),
+            "max_ms": max(overheads_ms),
+            "per_client_ms": statistics.mean(overheads_ms) / num_nodes,
+            "peak_rss_mb": peak_rss / 2**20,
+            "overheads_ms": overheads_ms,
+        }
+        results.append(result)
+        print(
+            f"{num_nodes:>6} {result['mean_ms']:>9.1f} {result['p50_ms']:>9.1f} "
+            f"{result['max_ms']:>9.1f} {result['per_client_ms']:>10.1f} "
+            f"{result['peak_rss_mb']:>8.1f}"
+        )
+
+    if len(results) > 1:
+        # Least-squares slope of mean workload overhead against node count.
+        nodes = [r["nodes"] for r in results]
+        means = [r["mean_ms"] for r in results]
+        slope = statistics.linear_regression(nodes, means).slope
+        print(f"Scaling: {slope:.1f} ms of overhead per workload per extra node")
+
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=4)
+
+    over_budget = [r for r in results if r["per_client_ms"] > budget_ms]
+    for r in over_budget:
+        print(
+            f"FAIL: {r['nodes']} nodes took {r['per_client_ms']:.1f} ms per "
+            f"client per workload, budget is {budget_ms} ms",
+            file=sys.stderr,
+        )
+    if over_budget:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+from typing import Dict, Optional
+
+
+class LogArchive:
+    """
+    Content-indexed local store for workload logs pulled off the VMs. Each
+    compressed log bundle is stored once under its sha256 digest, and an index
+    maps (workload id, node id) to the digest so that any workload's raw logs
+    can be re-analysed without re-running it.
+
+    Bundles are streamed in as chunks into a partial file whose size is the
+    resume offset, so an interrupted pull picks up where it left off. Partial
+    files are keyed on the sha256 of the remote bundle, so a resume never
+    appends to bytes from a different bundle for the same workload.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.partial_dir = os.path.join(root, "partial")
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.index: Dict[str, Dict[str, str]] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.index = json.load(file)
+
+    def _partial_path(self, workload_id, node_id, digest):
+        return os.path.join(
+            self.partial_dir, f"{workload_id}-{node_id}-{digest}.tar.gz.part"
+        )
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.tar.gz")
+
+    def offset(self, workload_id, node_id, digest):
+        """
+        Returns the number of bytes of the bundle with sha256 'digest' for
+        'workload_id' on 'node_id' that have already been received.
+        """
+        path = self._partial_path(workload_id, node_id, digest)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def append(self, workload_id, node_id, digest, chunk: bytes):
+        with open(self._partial_path(workload_id, node_id, digest), "ab") as file:
+            file.write(chunk)
+
+    def discard(self, workload_id, node_id, digest):
+        path = self._partial_path(workload_id, node_id, digest)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def commit(self, workload_id, node_id, expected_digest) -> str:
+        """
+        Moves a fully received bundle into the object store and records it in
+        the index. Raises ValueError, discarding the partial file, if its
+        sha256 does not match 'expected_digest'.
+        """
+        path = self._partial_path(workload_id, node_id, expected_digest)
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        if digest != expected_digest:
+            self.discard(workload_id, node_id, expected_digest)
+            raise ValueError(
+                f"Digest mismatch for {workload_id} on {node_id}: "
+                f"expected {expected_digest}, got {digest}"
+            )
+
+        object_path = self._object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.exists(object_path):
+            os.remove(path)
+        else:
+            shutil.move(path, object_path)
+
+        self.index.setdefault(workload_id, {})[node_id] = digest
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.index, file, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+        return digest
+
+    def lookup(self, workload_id, node_id) -> Optional[str]:
+        """
+        Returns the path of the stored bundle for 'workload_id' on 'node_id',
+        or None if it has not been archived.
+        """
+        digest = self.index.get(workload_id, {}).get(node_id)
+        return self._object_path(digest) if digest else None
+
+    def extract(self, workload_id, node_id, dest):
+        """
+        Unpacks the raw log files for 'workload_id' on 'node_id' into 'dest'.
+        """
+        path = self.lookup(workload_id, node_id)
+        if path is None:
+            raise KeyError(f"No logs archived for {workload_id} on {node_id}")
+        with tarfile.open(path, "r:gz") as tar:
+            tar.extractall(dest, filter="data")
@@ -1,8 +1,14 @@
 from click.types import Tuple
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import sys
+import time
 import typer
 import utils
 import json
 
+from log_archive import LogArchive
+
 from pydantic import BaseModel
 from typing import NamedTuple, Dict
 
@@ -11,6 +17,9 @@ class Workload(NamedTuple):
     is_epaxos: bool
     frac_writes: float
     theta: float
+    # Seconds of discarded load at the target mix before measurement starts.
+    # 0 skips the warm-up.
+    warmup_secs: int = 0
 
     def id(self):
         prot_str = "ep" if self.is_epaxos else "mp"
@@ -19,6 +28,13 @@ class Workload(NamedTuple):
         return f"{prot_str}_{write_str}_{theta_str}"
 
 
+REMOTE_LOG_DIR = "epaxos/logs"
+# Moves the latency samples recorded so far out of the way, so that the
+# metrics script only sees samples from the measured run.
+TAG_WARMUP_LOGS = "mv lattput.txt lattput_warmup.txt; mv latency.txt latency_warmup.txt"
+LOG_CHUNK_BYTES = 4 * 1024 * 1024
+
+
 LOCATION_TO_INDEX = {
     "or": 0,
     "va": 1,
@@ -28,12 +44,103 @@ LOCATION_TO_INDEX = {
 }
 
 
-class GCloudClient:
+class GCloudNode:
+    # File in the home directory that a long-running node process writes its
+    # output to, rotated by rotate_output.
+    OUTPUT_FILE = None
+
     def __init__(self, ip, loc):
         self.ip = ip
         self.loc = loc
+
+    def id(self):
+        raise NotImplementedError()
+
+    def internal_ip(self):
+        return self.ip[1]
+
+    def external_ip(self):
+        return self.ip[0]
+
+    def zone(self):
+        return {
+            "ca": "us-west2-b",
+            "va": "us-east4-a",
+            "eu": "europe-west6-a",
+            "or": "us-west1-b",
+            "jp": "asia-northeast2-c",
+        }[self.loc]
+
+    def gssh(self, cmd, desc):
+        # To see the commands that are run on each machine, uncomment the
+        # statements below.
+        # print(cmd)
+        # return lambda: None
+        print(f"Running '{cmd}' on {self.id()}")
+        return utils.execute(
+            self._gssh_cmd(cmd), "{}: {}".format(self.id(), desc)
+        )
+
+    def _gssh_cmd(self, cmd):
+        if isinstance(cmd, list):
+            cmd = "; ".join(cmd)
+
+        return "gcloud compute ssh {} --zone {} --command='{}'".format(
+            self.id(), self.zone(), cmd
+        )
+
+    def rotate_output(self, log_name):
+        # The process keeps its output file open in append mode, so copy and
+        # truncate it rather than moving it. Lines written between the tar and
+        # the truncate are lost. Prints the archive's size and sha256.
+        path = f"{REMOTE_LOG_DIR}/{log_name}.tar.gz"
+        rotate_command = (
+            f"mkdir -p {REMOTE_LOG_DIR} && test ! -e {path} && "
+            f"tar czf {path} --ignore-failed-read {self.OUTPUT_FILE} && "
+            f"truncate -s 0 {self.OUTPUT_FILE} && "
+            f"stat -c %s {path} && sha256sum {path}"
+        )
+        return self.gssh(rotate_command, f"Rotating {self.OUTPUT_FILE} as {log_name}")
+
+    def pending_logs(self):
+        pending_command = f"ls {REMOTE_LOG_DIR} 2>/dev/null || true"
+        return self.gssh(pending_command, "Listing rotated logs")
+
+    def log_stat(self, log_name):
+        # Prints the size and sha256 of the rotated archive.
+        path = f"{REMOTE_LOG_DIR}/{log_name}.tar.gz"
+        stat_command = f"stat -c %s {path} && sha256sum {path}"
+        return self.gssh(stat_command, f"Stat logs for {log_name}")
+
+    def fetch_log_chunk(self, log_name, offset, length):
+        path = f"{REMOTE_LOG_DIR}/{log_name}.tar.gz"
+        chunk_command = (
+            f"tail -c +{offset + 1} {path} | head -c {length} | base64 -w0"
+        )
+        return self.gssh(chunk_command, f"Fetching logs for {log_name} at {offset}")
+
+    def remove_log(self, log_name):
+        remove_command = f"rm -f {REMOTE_LOG_DIR}/{log_name}.tar.gz"
+        return self.gssh(remove_command, f"Removing shipped logs for {log_name}")
+
+
+class GCloudServer(GCloudNode):
+    OUTPUT_FILE = "output.txt"
+
+    def id(self):
+        return f"server-{self.loc}"
+
+
+class GCloudMaster(GCloudNode):
+    OUTPUT_FILE = "moutput.txt"
+
+    def id(self):
+        return f"master-{self.loc}"
+
+
+class GCloudClient(GCloudNode):
     @staticmethod
-    def from_pulumi_output() -> tuple[str, Dict[str, "GCloudClient"]]:
+    def from_pulumi_output() -> tuple[str, Dict[str, "GCloudClient"], Dict[str, GCloudNode]]:
         # get ips and locs from pulumi output
         pulumi_output = utils.execute(
             "pulumi stack output --json", "Fetching pulumi stack outputs"
@@ -79,44 +186,19 @@ class GCloudClient:
         clients = {}
         for loc, ips in ips_locs["clients"].items():
             clients[loc] = GCloudClient((ips["public"], ips["private"]), loc)
-        return (ips_locs["master"]["or"]["private"], clients)
+        # Servers and master are only reached to rotate and ship their logs.
+        nodes = {}
+        for loc, ips in ips_locs["servers"].items():
+            server = GCloudServer((ips["public"], ips["private"]), loc)
+            nodes[server.id()] = server
+        for loc, ips in ips_locs["master"].items():
+            master = GCloudMaster((ips["public"], ips["private"]), loc)
+            nodes[master.id()] = master
+        return (ips_locs["master"]["or"]["private"], clients, nodes)
 
     def id(self):
         return f"client-{self.loc}"
 
-    def internal_ip(self):
-        return self.ip[1]
-
-    def external_ip(self):
-        return self.ip[0]
-
-    def zone(self):
-        return {
-            "ca": "us-west2-b",
-            "va": "us-east4-a",
-            "eu": "europe-west6-a",
-            "or": "us-west1-b",
-            "jp": "asia-northeast2-c",
-        }[self.loc]
-
-    def gssh(self, cmd, desc):
-        # To see the commands that are run on each machine, uncomment the
-        # statements below.
-        # print(cmd)
-        # return lambda: None
-        print(f"Running '{cmd}' on {self.id()}")
-        return utils.execute(
-            self._gssh_cmd(cmd), "{}: {}".format(self.id(), desc)
-        )
-
-    def _gssh_cmd(self, cmd):
-        if isinstance(cmd, list):
-            cmd = "; ".join(cmd)
-
-        return "gcloud compute ssh {} --zone {} --command='{}'".format(
-            self.id(), self.zone(), cmd
-        )
-
     def flags(self, master_ip, workload: Workload):
         zipfian_flags = f"-c -1 -theta {workload.theta}"
         flags = [
@@ -129,12 +211,32 @@ class GCloudClient:
             flags.append(f"-l {LOCATION_TO_INDEX[self.loc]}")
         return " ".join(flags)
 
-    def run(self, master_ip, workload: Workload):
-        flags = self.flags(master_ip, workload)
-        client_command = (
-            f"cd epaxos && nohup bin/client {flags} > output_{workload.id()}.txt 2>&1 &"
-        )
-        return self.gssh(client_command, f"Running client for {workload.id()}")
+    def run(self, master_ip, workload: Workload, phase=None):
+        flag_workload = workload
+        if phase == "preload":
+            # Populate the key space: write-only with uniformly chosen keys.
+            flag_workload = workload._replace(frac_writes=1.0, theta=0.0)
+        flags = self.flags(master_ip, flag_workload)
+        output_name = f"output_{workload.id()}"
+        if phase is not None:
+            output_name += f"_{phase}"
+        client_command = f"nohup bin/client {flags} > {output_name}.txt 2>&1 &"
+        if phase is None and workload.warmup_secs > 0:
+            # Warm up and start the measured run in a single command, so no
+            # ssh round trips sit idle between them.
+            client_command = (
+                f"(timeout {workload.warmup_secs} bin/client {flags} "
+                f"> output_{workload.id()}_warmup.txt 2>&1; "
+                f"{TAG_WARMUP_LOGS}; true) && {client_command}"
+            )
+        desc = f"Running client for {workload.id()}"
+        if phase is not None:
+            desc += f" ({phase})"
+        return self.gssh(f"cd epaxos && {client_command}", desc)
+
+    def tag_warmup_logs(self):
+        tag_command = f"cd epaxos && ({TAG_WARMUP_LOGS}; true)"
+        return self.gssh(tag_command, f"Tagging warm-up logs on {self.id()}")
 
     def kill(self):
         kill_command = "kill $(pidof bin/client)"
@@ -148,6 +250,151 @@ class GCloudClient:
         metrics_command = "python3 epaxos/scripts/client_metrics.py"
         return self.gssh(metrics_command, f"Getting metrics for {workload.id()}")
 
+    def rotate_logs(self, workload: Workload, log_name):
+        # Bundle this workload's output and latency files into a compressed
+        # archive and remove the originals, so the next workload starts clean.
+        # Prints the archive's size and sha256.
+        files = (
+            f"output_{workload.id()}.txt output_{workload.id()}_preload.txt "
+            f"output_{workload.id()}_warmup.txt lattput.txt latency.txt "
+            "lattput_warmup.txt latency_warmup.txt"
+        )
+        path = f"logs/{log_name}.tar.gz"
+        rotate_command = (
+            f"cd epaxos && mkdir -p logs && test ! -e {path} && "
+            f"tar czf {path} --ignore-failed-read {files} && "
+            f"rm -f {files} && "
+            f"stat -c %s {path} && sha256sum {path}"
+        )
+        return self.gssh(rotate_command, f"Rotating logs for {workload.id()}")
+
+
+def log_name(log_id, sweep_id):
+    """
+    Names the remote archive for 'log_id' in sweep 'sweep_id'. Sweeps reuse
+    workload ids, so the sweep id keeps a rerun from overwriting an archive
+    that has not been shipped yet.
+    """
+    return f"{log_id}.{sweep_id}"
+
+
+def parse_log_stat(output, log_name):
+    """
+    Parses the size and sha256 printed after rotating or stat-ing an archive.
+    """
+    lines = output.splitlines()[-2:]
+    if len(lines) != 2 or not lines[0].isdigit():
+        raise ValueError(f"Could not stat logs for {log_name}")
+    return int(lines[0]), lines[1].split()[0]
+
+
+def preload(clients: Dict[str, GCloudClient], master_ip, workload: Workload, secs):
+    """
+    Populates the key space once for a whole sweep by running a write-only,
+    uniform-key load from every client at once for 'secs' seconds. The key
+    space lives on the servers, which stay up across workloads. 'workload'
+    only picks the protocol flags and names the output file.
+    """
+    try:
+        for client in clients.values():
+            print(client.run(master_ip, workload, phase="preload")())
+        utils.sleep_verbose("Preload", secs)
+    finally:
+        for client in clients.values():
+            print(client.kill()())
+    for client in clients.values():
+        print(client.tag_warmup_logs()())
+
+
+def ship_logs(node: GCloudNode, log_name, archive: LogArchive, stat=None):
+    """
+    Streams the rotated log archive 'log_name' off 'node' into 'archive' in
+    chunks of LOG_CHUNK_BYTES, resuming from whatever was already received.
+    'stat' is the archive's (size, sha256) if already known. The remote copy
+    is only deleted once its digest is verified.
+    """
+    log_id = log_name.split(".")[0]
+    if stat is None:
+        stat = parse_log_stat(node.log_stat(log_name)(), log_name)
+    size, digest = stat
+
+    if size == 0:
+        # tar leaves an empty archive behind when the disk fills up. There is
+        # nothing to recover, so drop it rather than retrying it every sweep.
+        print(f"Dropping empty log archive {log_name} on {node.id()}",
+              file=sys.stderr)
+        node.remove_log(log_name)()
+        return
+
+    offset = archive.offset(log_id, node.id(), digest)
+    if offset > size:
+        archive.discard(log_id, node.id(), digest)
+        offset = 0
+    while offset < size:
+        length = min(LOG_CHUNK_BYTES, size - offset)
+        chunk = base64.b64decode(node.fetch_log_chunk(log_name, offset, length)())
+        if not chunk:
+            raise ValueError(f"Empty chunk for {log_name} at {offset}")
+        archive.append(log_id, node.id(), digest, chunk)
+        offset += len(chunk)
+
+    archive.commit(log_id, node.id(), digest)
+    node.remove_log(log_name)()
+
+
+def try_ship_logs(node: GCloudNode, log_name, archive: LogArchive, stat=None):
+    """
+    Ships 'log_name' off 'node', printing rather than raising on failure. A
+    failed pull leaves the archive on the node, and it is resumed by
+    ship_pending_logs on the next sweep.
+    """
+    try:
+        ship_logs(node, log_name, archive, stat)
+    except Exception as e:
+        print(f"Failed to ship logs {log_name} from {node.id()}: {e}",
+              file=sys.stderr)
+
+
+def ship_pending_logs(node: GCloudNode, archive: LogArchive, sweep_id=None):
+    """
+    Ships any rotated archives left on 'node' by an interrupted sweep,
+    skipping those of the running sweep 'sweep_id'.
+    """
+    try:
+        names = node.pending_logs()().split()
+    except Exception as e:
+        print(f"Failed to list pending logs on {node.id()}: {e}", file=sys.stderr)
+        return
+    for name in names:
+        if not name.endswith(".tar.gz"):
+            continue
+        name = name[: -len(".tar.gz")]
+        if sweep_id is None or not name.endswith(f".{sweep_id}"):
+            try_ship_logs(node, name, archive)
+
+
+class LogShipper:
+    """
+    Ships rotated archives on a background thread, so a workload does not
+    wait for the previous one's logs to be pulled. A single worker keeps
+    LogArchive writes serialised.
+    """
+
+    def __init__(self, archive: LogArchive):
+        self.archive = archive
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def ship(self, node: GCloudNode, log_name, stat=None):
+        self.executor.submit(try_ship_logs, node, log_name, self.archive, stat)
+
+    def ship_pending(self, node: GCloudNode, sweep_id=None):
+        self.executor.submit(ship_pending_logs, node, self.archive, sweep_id)
+
+    def close(self):
+        """
+        Waits for every queued archive to be shipped.
+        """
+        self.executor.shutdown(wait=True)
 
 
 class MetricsData(BaseModel):
@@ -170,48 +417,139 @@ class WorkloadMetrics(BaseModel):
 class AllWorkloadsMetrics(BaseModel):
     workloads: Dict[str, WorkloadMetrics]
 
-def main(is_epaxos: bool):
-    master_ip, clients = GCloudClient.from_pulumi_output()
-    print(master_ip)
-    print(list((clients[loc].id(), clients[loc].ip) for loc in clients))
-
+def sweep_workloads(is_epaxos, warmup_secs=0):
+    """
+    Returns the workloads of a full sweep, grouped into rows by write fraction.
+    """
+    return [
+        [
+            Workload(
+                is_epaxos=is_epaxos,
+                frac_writes=frac_writes,
+                theta=theta,
+                warmup_secs=warmup_secs,
+            )
+            for theta in (x / 100 for x in range(60, 105, 5))
+        ]
+        for frac_writes in (x / 10 for x in range(0, 11))
+    ]
+
+
+def run_sweep(
+    master_ip,
+    clients: Dict[str, GCloudClient],
+    workload_rows,
+    archive: LogArchive,
+    file_name,
+    stabilize_secs=10,
+    on_workload=None,
+    nodes: Dict[str, GCloudNode] = {},
+    preload_secs=0,
+) -> AllWorkloadsMetrics:
+    """
+    Runs every workload in 'workload_rows' on each of 'clients' and collects
+    their metrics, rewriting 'file_name' after each row. If 'preload_secs' is
+    positive, the key space is populated once before the first workload.
+    Preload is a sweep-level setting on purpose, not a Workload field: the key
+    space lives on the servers, which stay up for the whole sweep. Warm-up is
+    per workload, through Workload.warmup_secs.
+
+    After each workload the client logs and the output of 'nodes' (servers
+    and master) are rotated into per-workload archives and shipped into
+    'archive' in the background; the sweep waits for shipping only at the
+    end. 'on_workload', if given, is called with each workload once it has
+    finished.
+    """
     # Populate all workloads metrics
     # all_workloads_metrics = AllWorkloadsMetrics(workloads={workload.id(): workload_metrics})
     all_workloads_metrics = AllWorkloadsMetrics(workloads={})
-    file_name = f'{'ep' if is_epaxos else 'mp'}_workload_metrics.json'
-
-    # for _, client in clients.items():
-    #     remove_output = client.clean_logs()
-    for frac_writes in (x / 10 for x in range(0, 11)):
-        for theta in (x / 100 for x in range(60, 105, 5)):
-            workload = Workload(
-                is_epaxos=is_epaxos, frac_writes=frac_writes, theta=theta
-            )
-            print('####################################')
-            print(f'#####{workload}#####')
-            print('####################################')
-            workload_metrics = WorkloadMetrics(clients={})
-            for _, client in clients.items():
-                    try:
-                        output = client.run(master_ip, workload)
-                        print(output())
-                        utils.sleep_verbose('Stabilizing', 10)
-                    finally:
-                        kill_output = client.kill()
-                        print(kill_output())
+
+    sweep_id = time.strftime("%Y%m%dT%H%M%S")
+    shipper = LogShipper(archive)
+    for node in list(clients.values()) + list(nodes.values()):
+        shipper.ship_pending(node, sweep_id)
+    try:
+        # for _, client in clients.items():
+        #     remove_output = client.clean_logs()
+        if preload_secs > 0 and workload_rows and workload_rows[0]:
+            preload(clients, master_ip, workload_rows[0][0], preload_secs)
+        for row in workload_rows:
+            for workload in row:
+                print('####################################')
+                print(f'#####{workload}#####')
+                print('####################################')
+                workload_metrics = WorkloadMetrics(clients={})
+                for _, client in clients.items():
+                        try:
+                            output = client.run(master_ip, workload)
+                            print(output())
+                            utils.sleep_verbose('Stabilizing', stabilize_secs)
+                        finally:
+                            kill_output = client.kill()
+                            print(kill_output())
+                        try:
+                            # get metrics
+                            metrics_output = client.get_metrics(workload)
+                            metrics_data = json.loads(metrics_output())
+                            metrics_data = MetricsData(**metrics_data)
+                            workload_metrics.clients[client.id()] = metrics_data
+                        except:
+                            continue
+                        finally:
+                            name = log_name(workload.id(), sweep_id)
+                            try:
+                                stat = parse_log_stat(
+                                    client.rotate_logs(workload, name)(), name
+                                )
+                                shipper.ship(client, name, stat)
+                            except Exception as e:
+                                print(f"Failed to rotate logs on {client.id()}: {e}",
+                                      file=sys.stderr)
+
+                # Rotate every server and master at once, one round trip in total.
+                name = log_name(workload.id(), sweep_id)
+                rotations = [(node, node.rotate_output(name)) for node in nodes.values()]
+                for node, rotation in rotations:
                     try:
-                        # get metrics
-                        metrics_output = client.get_metrics(workload)
-                        metrics_data = json.loads(metrics_output())
-                        metrics_data = MetricsData(**metrics_data)
-                        workload_metrics.clients[client.id()] = metrics_data
-                    except:
-                        continue
-
-            all_workloads_metrics.workloads[workload.id()] = workload_metrics
-        # Print the final metrics for verification
-        with open(file_name, 'w') as file:
-            json.dump(all_workloads_metrics.model_dump(), file, indent=4)
+                        shipper.ship(node, name, parse_log_stat(rotation(), name))
+                    except Exception as e:
+                        print(f"Failed to rotate logs on {node.id()}: {e}",
+                              file=sys.stderr)
+
+                all_workloads_metrics.workloads[workload.id()] = workload_metrics
+                if on_workload is not None:
+                    on_workload(workload)
+            # Print the final metrics for verification
+            with open(file_name, 'w') as file:
+                json.dump(all_workloads_metrics.model_dump(), file, indent=4)
+    finally:
+        shipper.close()
+
+    return all_workloads_metrics
+
+
+def main(
+    is_epaxos: bool,
+    log_dir: str = "logs",
+    preload_secs: int = 0,
+    warmup_secs: int = 0,
+):
+    master_ip, clients, nodes = GCloudClient.from_pulumi_output()
+    print(master_ip)
+    print(list((clients[loc].id(), clients[loc].ip) for loc in clients))
+
+    archive = LogArchive(log_dir)
+
+    file_name = f"{'ep' if is_epaxos else 'mp'}_workload_metrics.json"
+    run_sweep(
+        master_ip,
+        clients,
+        sweep_workloads(is_epaxos, warmup_secs),
+        archive,
+        file_name,
+        nodes=nodes,
+        preload_secs=preload_secs,
+    )
 
     print(f"Workload metrics have been written to '{file_name}'")
 